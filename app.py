@@ -1,12 +1,11 @@
 
-import io, os, re, smtplib, ssl, tempfile
+import hashlib, io, os, smtplib, ssl, threading
 from email.message import EmailMessage
 from datetime import datetime, date
 import pandas as pd
 import streamlit as st
-from sqlalchemy import create_engine, text
-from sqlalchemy.pool import NullPool
-from PIL import Image
+from sqlalchemy import create_engine, event, text
+from PIL import Image, ImageOps
 
 # ====== Minimal style ======
 CUSTOM_CSS = """
@@ -23,7 +22,25 @@ st.markdown(CUSTOM_CSS, unsafe_allow_html=True)
 
 # ====== Config ======
 DB_URL = "sqlite:///rnc.db"
-engine = create_engine(DB_URL, poolclass=NullPool, future=True)
+
+def _sqlite_on_connect(dbapi_conn, _rec):
+    # SQLite's LIKE/lower() only fold ASCII; filters use this for "Área" vs "área".
+    dbapi_conn.create_function("py_lower", 1, lambda s: s.lower() if isinstance(s, str) else s, deterministic=True)
+    cur = dbapi_conn.cursor()
+    cur.execute("PRAGMA journal_mode=WAL")
+    cur.execute("PRAGMA synchronous=NORMAL")
+    cur.execute("PRAGMA temp_store=MEMORY")
+    cur.execute("PRAGMA mmap_size=268435456")
+    cur.close()
+
+@st.cache_resource
+def get_engine():
+    eng = create_engine(DB_URL, future=True)
+    event.listen(eng, "connect", _sqlite_on_connect)
+    return eng
+
+engine = get_engine()
+
 QUALITY_PASS = os.getenv("QUALITY_PASS", "qualidade123")
 
 SMTP_HOST = os.getenv("SMTP_HOST", "")
@@ -35,6 +52,27 @@ EMAIL_TO = [e.strip() for e in os.getenv("EMAIL_TO", "").split(",") if e.strip()
 APP_BASE_URL = os.getenv("APP_BASE_URL", "")
 
 # ====== DB & Migrations ======
+# Columns added after the first release; older rnc.db files get them via ALTER TABLE.
+MIGRATIONS = {
+    "inspecoes": {
+        "encerramento_desc": "TEXT",
+        "reabertura_desc": "TEXT",
+        "cancelada_em": "TIMESTAMP",
+        "cancelada_por": "TEXT",
+        "cancelamento_motivo": "TEXT",
+    },
+    "fotos": {
+        "thumb": "BLOB",
+    },
+}
+
+def _add_missing_columns(conn, table:str, cols:dict):
+    existing = {r[1] for r in conn.exec_driver_sql(f"PRAGMA table_info({table})")}
+    for name, decl in cols.items():
+        if name not in existing:
+            conn.exec_driver_sql(f"ALTER TABLE {table} ADD COLUMN {name} {decl}")
+
+@st.cache_resource
 def init_db():
     with engine.begin() as conn:
         conn.exec_driver_sql("""
@@ -78,60 +116,95 @@ def init_db():
             blob BLOB NOT NULL,
             filename TEXT,
             mimetype TEXT,
-            tipo TEXT CHECK(tipo IN ('abertura','encerramento','reabertura')) DEFAULT 'abertura'
+            tipo TEXT CHECK(tipo IN ('abertura','encerramento','reabertura')) DEFAULT 'abertura',
+            thumb BLOB
         );""")
         conn.exec_driver_sql("""
         CREATE TABLE IF NOT EXISTS peps (id INTEGER PRIMARY KEY AUTOINCREMENT, code TEXT UNIQUE);""" )
         conn.exec_driver_sql("""
         CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, blob BLOB, text TEXT);""" )
+        conn.exec_driver_sql("""
+        CREATE TABLE IF NOT EXISTS rnc_counters (year INTEGER PRIMARY KEY, seq INTEGER NOT NULL DEFAULT 0);""" )
+        for table, cols in MIGRATIONS.items():
+            _add_missing_columns(conn, table, cols)
+        conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_insp_rnc ON inspecoes(rnc_num)")
+        conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_insp_rnc_trim ON inspecoes(trim(rnc_num))")
+        conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_insp_status ON inspecoes(status)")
+        conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_insp_sev ON inspecoes(severidade)")
+        conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_insp_pep ON inspecoes(pep)")
+        conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_fotos_iid_tipo ON fotos(inspecao_id, tipo)")
+        sync_rnc_counters(conn)
 
 def settings_set_logo(image_bytes: bytes):
+    try:
+        im = Image.open(io.BytesIO(image_bytes))
+        if im.format == "PNG":
+            buf = io.BytesIO()
+            im.save(buf, format="PNG", optimize=True, compress_level=9)
+            image_bytes = min(image_bytes, buf.getvalue(), key=len)
+    except Exception:
+        pass
     with engine.begin() as conn:
         conn.execute(text("INSERT INTO settings(key, blob) VALUES('logo', :b) ON CONFLICT(key) DO UPDATE SET blob=excluded.blob"), {"b": image_bytes})
+    settings_get_logo.clear(); generate_pdf.clear()
+    return image_bytes
 
+@st.cache_data(ttl=60, show_spinner=False)
 def settings_get_logo():
-    with engine.begin() as conn:
+    with engine.connect() as conn:
         row = conn.execute(text("SELECT blob FROM settings WHERE key='logo'")).fetchone()
     return row[0] if row else None
 
 def settings_clear_logo():
     with engine.begin() as conn:
         conn.execute(text("DELETE FROM settings WHERE key='logo'"))
+    settings_get_logo.clear(); generate_pdf.clear()
 
+@st.cache_data(ttl=60, show_spinner=False)
 def get_pep_list():
-    with engine.begin() as conn:
-        df = pd.read_sql(text("SELECT code FROM peps ORDER BY code"), conn)
-    return df["code"].tolist() if not df.empty else []
+    with engine.connect() as conn:
+        return [r[0] for r in conn.execute(text("SELECT code FROM peps ORDER BY code"))]
 
 def add_peps_bulk(codes:list):
-    codes = [c.strip() for c in codes if c and c.strip()]
+    codes = list(dict.fromkeys(c.strip() for c in codes if c and c.strip()))
     if not codes: return 0
-    ins = 0
     with engine.begin() as conn:
-        for code in codes:
-            try:
-                conn.execute(text("INSERT OR IGNORE INTO peps (code) VALUES (:c)"), {"c": code})
-                ins += 1
-            except Exception:
-                pass
-    return ins
+        res = conn.execute(text("INSERT INTO peps (code) VALUES (:c) ON CONFLICT(code) DO NOTHING"), [{"c": c} for c in codes])
+    get_pep_list.clear()
+    return max(res.rowcount, 0)
+
+def sync_rnc_counters(conn):
+    # Bring rnc_counters up to the highest YYYY-NNN already stored (first run, CSV imports).
+    conn.exec_driver_sql("""
+        INSERT INTO rnc_counters (year, seq)
+        SELECT CAST(substr(rnc_num, 1, 4) AS INTEGER), MAX(CAST(substr(rnc_num, 6) AS INTEGER))
+          FROM inspecoes
+         WHERE rnc_num GLOB '[0-9][0-9][0-9][0-9]-[0-9]*' AND substr(rnc_num, 6) NOT GLOB '*[^0-9]*'
+         GROUP BY 1
+        ON CONFLICT(year) DO UPDATE SET seq=MAX(seq, excluded.seq)
+    """)
+
+def take_rnc_num(conn, year:int) -> str:
+    seq = conn.execute(text("""
+        INSERT INTO rnc_counters (year, seq) VALUES (:y, 1)
+        ON CONFLICT(year) DO UPDATE SET seq=seq+1 RETURNING seq
+    """), {"y": year}).scalar_one()
+    return f"{year}-{seq:03d}"
 
 def next_rnc_num_for_date(d:date) -> str:
     year = d.year
-    with engine.begin() as conn:
-        rows = conn.execute(text("SELECT rnc_num FROM inspecoes WHERE rnc_num LIKE :p"), {"p": f"{year}-%"}).fetchall()
-    seqs = []
-    for (val,) in rows:
-        if not val: continue
-        m = re.match(rf"^{year}-(\d+)$", str(val).strip())
-        if m:
-            try: seqs.append(int(m.group(1)))
-            except: pass
-    nxt = (max(seqs)+1) if seqs else 1
+    with engine.connect() as conn:
+        last = conn.execute(text("SELECT seq FROM rnc_counters WHERE year=:y"), {"y": year}).scalar()
+    nxt = (int(last)+1) if last else 1
     return f"{year}-{nxt:03d}"
 
+@st.cache_data(ttl=5, show_spinner=False)
+def next_rnc_preview(d:date) -> str:
+    return next_rnc_num_for_date(d)
+
 def insert_inspecao(rec, images: list):
     with engine.begin() as conn:
+        rec = {**rec, "rnc_num": take_rnc_num(conn, rec["data"].year)}
         conn.execute(text("""
             INSERT INTO inspecoes (data, rnc_num, emitente, area, pep, titulo, responsavel, descricao, referencias,
                                    causador, processo_envolvido, origem, acao_correcao,
@@ -141,41 +214,73 @@ def insert_inspecao(rec, images: list):
                     :severidade, :categoria, :acoes, :status, :responsavel_acao)
         """), rec)
         iid = conn.execute(text("SELECT last_insert_rowid()")).scalar_one()
-        for img in images:
-            conn.execute(text("""
-                INSERT INTO fotos (inspecao_id, blob, filename, mimetype, tipo)
-                VALUES (:iid, :blob, :name, :mime, 'abertura')
-            """), {"iid": iid, "blob": img["blob"], "name": img["name"], "mime": img["mime"]})
-        return iid
-
-def fetch_df():
-    with engine.begin() as conn:
-        df = pd.read_sql(text("""
+        _insert_photos(conn, iid, images, "abertura")
+    fetch_df.clear(); next_rnc_preview.clear()
+    return iid, rec["rnc_num"]
+
+def like_pattern(s: str) -> str:
+    return "%" + s.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+
+def parse_dt(s: pd.Series) -> pd.Series:
+    out = pd.to_datetime(s, errors="coerce", format="ISO8601")
+    miss = out.isna() & s.notna()
+    if miss.any():
+        out[miss] = pd.to_datetime(s[miss], errors="coerce", format="mixed")
+    return out
+
+@st.cache_data(ttl=60, max_entries=64, show_spinner=False)
+def fetch_df(status=None, severidade=None, area=None, responsavel=None, pep=None):
+    where, params = [], {}
+    for col, vals in (("status", status), ("severidade", severidade)):
+        if vals:
+            keys = [f"{col}_{i}" for i in range(len(vals))]
+            where.append(f"{col} IN ({', '.join(':'+k for k in keys)})")
+            params.update(zip(keys, vals))
+    for col, val in (("area", area), ("responsavel", responsavel), ("pep", pep)):
+        if val:
+            where.append(f"py_lower({col}) LIKE py_lower(:{col}) ESCAPE '\\'")
+            params[col] = like_pattern(val)
+    with engine.connect() as conn:
+        df = pd.read_sql(text(f"""
             SELECT id, data, rnc_num, emitente, area, pep, titulo, responsavel,
                    severidade, categoria, status, descricao, referencias,
                    causador, processo_envolvido, origem, acao_correcao,
                    acoes, encerrada_em, encerrada_por, encerramento_obs, eficacia,
                    responsavel_acao, reaberta_em, reaberta_por, reabertura_motivo,
                    encerramento_desc, reabertura_desc, cancelada_em, cancelada_por, cancelamento_motivo
-            FROM inspecoes ORDER BY id DESC
-        """), conn)
+            FROM inspecoes {"WHERE " + " AND ".join(where) if where else ""} ORDER BY id DESC
+        """), conn, params=params)
     if "data" in df.columns:
-        df["data"] = pd.to_datetime(df["data"], errors="coerce").dt.date
+        df["data"] = parse_dt(df["data"]).dt.date
     return df
 
-def fetch_photos(iid:int, tipo:str):
-    with engine.begin() as conn:
-        df = pd.read_sql(text("SELECT id, blob, filename, mimetype FROM fotos WHERE inspecao_id=:iid AND tipo=:tipo ORDER BY id"),
-                         conn, params={"iid": iid, "tipo": tipo})
-    return df.to_dict("records") if not df.empty else []
+def fetch_photos_all(iid:int) -> dict:
+    out = {"abertura": [], "encerramento": [], "reabertura": []}
+    with engine.connect() as conn:
+        for r in conn.execute(text("SELECT id, filename, mimetype, tipo FROM fotos WHERE inspecao_id=:iid ORDER BY tipo, id"),
+                              {"iid": iid}).mappings():
+            out.setdefault(r["tipo"], []).append(dict(r))
+    return out
+
+def fetch_photo_blob(photo_id:int):
+    with engine.connect() as conn:
+        return conn.execute(text("SELECT blob FROM fotos WHERE id=:pid"), {"pid": int(photo_id)}).scalar()
+
+def fetch_photo_thumb(photo_id:int):
+    with engine.connect() as conn:
+        return conn.execute(text("SELECT COALESCE(thumb, blob) FROM fotos WHERE id=:pid"), {"pid": int(photo_id)}).scalar()
+
+def _insert_photos(conn, iid:int, images:list, tipo:str):
+    if not images: return
+    conn.execute(text("""
+        INSERT INTO fotos (inspecao_id, blob, filename, mimetype, tipo, thumb)
+        VALUES (:iid, :blob, :name, :mime, :tipo, :thumb)
+    """), [{"iid": iid, "blob": img["blob"], "name": img["name"], "mime": img["mime"], "tipo": tipo, "thumb": img.get("thumb")} for img in images])
 
 def add_photos(iid:int, images:list, tipo:str):
+    if not images: return
     with engine.begin() as conn:
-        for img in images:
-            conn.execute(text("""
-                INSERT INTO fotos (inspecao_id, blob, filename, mimetype, tipo)
-                VALUES (:iid, :blob, :name, :mime, :tipo)
-            """), {"iid": iid, "blob": img["blob"], "name": img["name"], "mime": img["mime"], "tipo": tipo})
+        _insert_photos(conn, iid, images, tipo)
 
 def encerrar_inspecao(iid:int, por:str, obs:str, eficacia:str, desc:str, images:list):
     with engine.begin() as conn:
@@ -189,8 +294,8 @@ def encerrar_inspecao(iid:int, por:str, obs:str, eficacia:str, desc:str, images:
                    encerramento_desc=:desc
              WHERE id=:iid
         """), {"dt": datetime.now(), "por": por, "obs": obs, "ef": efficacy_map(eficacia), "desc": desc, "iid": iid})
-    if images:
-        add_photos(iid, images, "encerramento")
+        _insert_photos(conn, iid, images, "encerramento")
+    fetch_df.clear()
 
 def reabrir_inspecao(iid:int, por:str, motivo:str, desc:str, images:list):
     with engine.begin() as conn:
@@ -203,8 +308,8 @@ def reabrir_inspecao(iid:int, por:str, motivo:str, desc:str, images:list):
                    reabertura_desc=:desc
              WHERE id=:iid
         """), {"dt": datetime.now(), "por": por, "motivo": motivo, "desc": desc, "iid": iid})
-    if images:
-        add_photos(iid, images, "reabertura")
+        _insert_photos(conn, iid, images, "reabertura")
+    fetch_df.clear()
 
 def cancel_inspecao(iid:int, por:str, motivo:str):
     with engine.begin() as conn:
@@ -216,25 +321,28 @@ def cancel_inspecao(iid:int, por:str, motivo:str):
                    cancelamento_motivo=:motivo
              WHERE id=:iid
         """), {"dt": datetime.now(), "por": por, "motivo": motivo, "iid": iid})
+    fetch_df.clear()
 
 def delete_inspecao(iid:int):
     with engine.begin() as conn:
         conn.execute(text("DELETE FROM fotos WHERE inspecao_id=:iid"), {"iid": iid})
         conn.execute(text("DELETE FROM inspecoes WHERE id=:iid"), {"iid": iid})
+    fetch_df.clear(); next_rnc_preview.clear()
 
 # ====== PDF (ReportLab) ======
-def generate_pdf(iid:int) -> str:
+@st.cache_data(ttl=3600, max_entries=32, show_spinner=False)
+def generate_pdf(iid:int, version:tuple=()) -> bytes:
     from reportlab.lib.pagesizes import A4
     from reportlab.pdfgen import canvas
     from reportlab.lib.units import mm
     from reportlab.lib.utils import ImageReader
+    from reportlab.pdfbase.pdfmetrics import stringWidth
 
     df = fetch_df()
     row = df[df["id"] == iid].iloc[0].to_dict()
 
-    fd, path = tempfile.mkstemp(suffix=f"_RNC_{row.get('rnc_num','')}.pdf")
-    os.close(fd)
-    c = canvas.Canvas(path, pagesize=A4)
+    buf = io.BytesIO()
+    c = canvas.Canvas(buf, pagesize=A4)
     W, H = A4
 
     y = H - 20*mm
@@ -267,23 +375,36 @@ def generate_pdf(iid:int) -> str:
         c.setFont("Helvetica", 9)
         maxw = W - 30*mm
         ypos = y_start - 4*mm
-        for line in _wrap_text(str(text or "-"), c, maxw):
+        for line in _wrap_text(str(text or "-"), maxw):
             c.drawString(15*mm, ypos, line)
             ypos -= 5*mm
             if ypos < 20*mm:
                 c.showPage(); ypos = H - 20*mm
         return ypos
 
-    def _wrap_text(text, canv, maxw):
+    char_w = {}
+    def _width(s):
+        w = 0.0
+        for ch in s:
+            cw = char_w.get(ch)
+            if cw is None:
+                cw = char_w[ch] = stringWidth(ch, "Helvetica", 9)
+            w += cw
+        return w
+
+    def _wrap_text(text, maxw):
         words = str(text).split()
-        lines, cur = [], ""
+        space_w = _width(" ")
+        lines, cur, cur_w = [], "", 0.0
         for w in words:
-            test = (cur + " " + w).strip()
-            if canv.stringWidth(test, "Helvetica", 9) <= maxw:
-                cur = test
+            ww = _width(w)
+            if not cur:
+                cur, cur_w = w, ww
+            elif cur_w + space_w + ww <= maxw:
+                cur, cur_w = cur + " " + w, cur_w + space_w + ww
             else:
-                if cur: lines.append(cur)
-                cur = w
+                lines.append(cur)
+                cur, cur_w = w, ww
         if cur: lines.append(cur)
         return lines or ["-"]
 
@@ -312,8 +433,9 @@ def generate_pdf(iid:int) -> str:
         y = draw_block("Cancelada por / Em:", f"{row.get('cancelada_por') or '-'} / {row.get('cancelada_em') or '-'}", y - 6*mm)
 
     # Fotos
+    photos = fetch_photos_all(iid)
     for tipo, titulo in [("abertura","Fotos da abertura"), ("encerramento","Evidências de encerramento"), ("reabertura","Fotos da reabertura")]:
-        pics = fetch_photos(iid, tipo)
+        pics = photos[tipo]
         if not pics: continue
         c.setFont("Helvetica-Bold", 10)
         c.drawString(15*mm, y - 4*mm, titulo + ":")
@@ -321,7 +443,7 @@ def generate_pdf(iid:int) -> str:
         x = 15*mm
         for rec in pics:
             try:
-                img = ImageReader(io.BytesIO(rec["blob"]))
+                img = ImageReader(io.BytesIO(fetch_photo_blob(rec["id"])))
                 w, h = 60*mm, 45*mm
                 if x + w > W - 15*mm:
                     x = 15*mm
@@ -336,12 +458,26 @@ def generate_pdf(iid:int) -> str:
 
     c.showPage()
     c.save()
-    return path
+    return buf.getvalue()
 
 # ====== Emails ======
 def email_enabled():
     return all([SMTP_HOST, SMTP_USER, SMTP_PASS, EMAIL_FROM, EMAIL_TO])
 
+@st.cache_resource
+def _smtp_state():
+    return {"server": None, "lock": threading.Lock()}
+
+def _smtp_connect():
+    context = ssl.create_default_context()
+    if SMTP_PORT == 465:
+        server = smtplib.SMTP_SSL(SMTP_HOST, SMTP_PORT, context=context, timeout=30)
+    else:
+        server = smtplib.SMTP(SMTP_HOST, SMTP_PORT, timeout=30)
+        server.starttls(context=context)
+    server.login(SMTP_USER, SMTP_PASS)
+    return server
+
 def send_email(subject: str, body: str):
     if not email_enabled():
         return False, "E-mail não configurado (defina SMTP_* e EMAIL_*)."
@@ -351,11 +487,17 @@ def send_email(subject: str, body: str):
         msg["From"] = EMAIL_FROM
         msg["To"] = ", ".join(EMAIL_TO)
         msg.set_content(body)
-        context = ssl.create_default_context()
-        with smtplib.SMTP(SMTP_HOST, SMTP_PORT) as server:
-            server.starttls(context=context)
-            server.login(SMTP_USER, SMTP_PASS)
-            server.send_message(msg)
+        state = _smtp_state()
+        with state["lock"]:
+            for retry in (False, True):
+                try:
+                    if state["server"] is None:
+                        state["server"] = _smtp_connect()
+                    state["server"].send_message(msg)
+                    break
+                except smtplib.SMTPServerDisconnected:
+                    state["server"] = None
+                    if retry: raise
         return True, "ok"
     except Exception as e:
         return False, str(e)
@@ -372,37 +514,88 @@ EXPECTED_COLS = [
     "encerramento_desc","reabertura_desc","cancelada_em","cancelada_por","cancelamento_motivo"
 ]
 
+CSV_CHUNK_ROWS = 50_000
+CSV_SEPARATORS = [",", ";", "\t"]
+
+def upload_digest(up) -> bytes:
+    return hashlib.blake2b(up.getvalue(), digest_size=16).digest()
+
+def sniff_sep(up) -> str:
+    header = (up.read(8192).splitlines() or [b""])[0]; up.seek(0)
+    return max(CSV_SEPARATORS, key=lambda d: header.count(d.encode()))
+
+COL_ALIASES = {"rnc_nº":"rnc_num","rnc_no":"rnc_num","rnc":"rnc_num","responsável":"responsavel","pep_descricao":"pep"}
+
 def normalize_df_cols(df: pd.DataFrame) -> pd.DataFrame:
-    aliases = {"rnc nº":"rnc_num","rnc_no":"rnc_num","rnc":"rnc_num","responsável":"responsavel","pep_descricao":"pep"}
-    df.columns = [aliases.get(str(c).strip().lower().replace(" ","_"), str(c).strip().lower().replace(" ","_")) for c in df.columns]
-    for c in EXPECTED_COLS:
-        if c not in df.columns: df[c] = None
-    df = df[EXPECTED_COLS]
+    df.columns = df.columns.astype(str).str.strip().str.lower().str.replace(" ", "_").map(lambda c: COL_ALIASES.get(c, c))
+    df = df.loc[:, ~df.columns.duplicated()].reindex(columns=EXPECTED_COLS)
     for dtcol in ["data","encerrada_em","reaberta_em","cancelada_em"]:
-        df[dtcol] = pd.to_datetime(df[dtcol], errors="coerce")
+        df[dtcol] = parse_dt(df[dtcol])
     return df
 
-def upsert_from_csv(df: pd.DataFrame) -> int:
+def _upsert_chunk(conn, df: pd.DataFrame) -> int:
+    cols = [k for k in EXPECTED_COLS if k != "id"]
+    conn.exec_driver_sql("DROP TABLE IF EXISTS temp._stage_insp")
+    conn.exec_driver_sql(f"CREATE TEMP TABLE _stage_insp ({', '.join(cols)})")
+    try:
+        df[cols].to_sql("_stage_insp", conn, if_exists="append", index=False)
+        conn.exec_driver_sql(f"""
+            UPDATE inspecoes SET {', '.join(f'{k}=s.{k}' for k in cols)}
+              FROM temp._stage_insp s
+             WHERE trim(inspecoes.rnc_num) = trim(s.rnc_num) AND trim(s.rnc_num) <> ''
+        """)
+        conn.exec_driver_sql(f"""
+            INSERT INTO inspecoes ({', '.join(cols)})
+            SELECT {', '.join('s.'+k for k in cols)} FROM temp._stage_insp s
+             WHERE trim(COALESCE(s.rnc_num, '')) = ''
+                OR trim(s.rnc_num) NOT IN (SELECT trim(rnc_num) FROM inspecoes WHERE rnc_num IS NOT NULL)
+        """)
+    finally:
+        conn.exec_driver_sql("DROP TABLE IF EXISTS temp._stage_insp")
+    return len(df)
+
+def upsert_from_csv(dfs) -> int:
+    if isinstance(dfs, pd.DataFrame): dfs = [dfs]
     n = 0
     with engine.begin() as conn:
-        existing = pd.read_sql(text("SELECT id, rnc_num FROM inspecoes"), conn)
-        exist_map = {str(r).strip(): i for i, r in zip(existing["id"], existing["rnc_num"].fillna("").astype(str))}
-        for _, row in df.iterrows():
-            rnc_key = str(row.get("rnc_num") or "").strip()
-            rec = {k: (None if pd.isna(v) else v) for k, v in row.items() if k in EXPECTED_COLS and k != "id"}
-            for k in ["data","encerrada_em","reaberta_em","cancelada_em"]:
-                if isinstance(rec.get(k), pd.Timestamp):
-                    rec[k] = rec[k].to_pydatetime()
-            if rnc_key and rnc_key in exist_map:
-                rec["id"] = int(exist_map[rnc_key])
-                sets = ", ".join([f"{k}=:{k}" for k in rec.keys() if k != "id"])
-                conn.execute(text(f"UPDATE inspecoes SET {sets} WHERE id=:id"), rec)
-            else:
-                cols = [k for k in EXPECTED_COLS if k != "id"]
-                conn.execute(text(f"INSERT INTO inspecoes ({', '.join(cols)}) VALUES ({', '.join(':'+k for k in cols)})"), rec)
-            n += 1
+        for df in dfs:
+            n += _upsert_chunk(conn, df)
+        sync_rnc_counters(conn)
+    fetch_df.clear(); next_rnc_preview.clear(); generate_pdf.clear(); export_csv_bytes.clear()
     return n
 
+EXPORT_CHUNK_ROWS = 50_000
+
+def iter_csv(df: pd.DataFrame, chunksize:int=EXPORT_CHUNK_ROWS):
+    for i in range(0, len(df), chunksize):
+        chunk = df.iloc[i:i+chunksize].to_csv(index=False, sep=";", header=(i == 0))
+        yield chunk.encode("utf-8-sig" if i == 0 else "utf-8")
+
+def export_version() -> tuple:
+    with engine.connect() as conn:
+        return tuple(conn.execute(text("""
+            SELECT COUNT(*), MAX(id), MAX(encerrada_em), MAX(reaberta_em), MAX(cancelada_em) FROM inspecoes
+        """)).one())
+
+@st.cache_data(ttl=60, show_spinner=False)
+def export_csv_bytes(version:tuple) -> bytes:
+    df = fetch_df()
+    try:
+        import pyarrow as pa
+        import pyarrow.csv as pac
+    except ImportError:
+        return b"".join(iter_csv(df))
+    try:
+        schema = pa.Schema.from_pandas(df, preserve_index=False)
+        sink = pa.BufferOutputStream()
+        sink.write(b"\xef\xbb\xbf")
+        with pac.CSVWriter(sink, schema, write_options=pac.WriteOptions(delimiter=";")) as writer:
+            for i in range(0, len(df), EXPORT_CHUNK_ROWS):
+                writer.write_table(pa.Table.from_pandas(df.iloc[i:i+EXPORT_CHUNK_ROWS], schema=schema, preserve_index=False))
+        return sink.getvalue().to_pybytes()
+    except pa.ArrowException:
+        return b"".join(iter_csv(df))
+
 # ====== UI & Auth ======
 init_db()
 if "is_quality" not in st.session_state:
@@ -428,12 +621,17 @@ with st.sidebar.expander("🖼️ Logo da empresa (para PDF e topo)"):
         st.image(Image.open(io.BytesIO(logo_bytes)), width=180)
         if st.button("Remover logo atual"):
             settings_clear_logo()
+            st.session_state.pop("last_logo_hash", None)
             st.warning("Logo removida. Recarregue a página para atualizar.")
     if st.session_state.is_quality:
         up_logo = st.file_uploader("Enviar nova logo (PNG/JPG)", type=["png","jpg","jpeg"])
         if up_logo is not None:
-            settings_set_logo(up_logo.getbuffer().tobytes())
-            st.success("Logo atualizada! Recarregue a página para ver.")
+            h = upload_digest(up_logo)
+            stored = hashlib.blake2b(logo_bytes, digest_size=16).digest() if logo_bytes else None
+            if st.session_state.get("last_logo_hash") != (h, stored):
+                saved = settings_set_logo(up_logo.getbuffer().tobytes())
+                st.session_state["last_logo_hash"] = (h, hashlib.blake2b(saved, digest_size=16).digest())
+                st.success("Logo atualizada! Recarregue a página para ver.")
 
 # Menu
 if st.session_state.is_quality:
@@ -441,17 +639,38 @@ if st.session_state.is_quality:
 else:
     menu = st.sidebar.radio("Navegação", ["Consultar/Encerrar/Reabrir", "Importar/Exportar"], label_visibility="collapsed")
 
+PHOTO_MAX_PX = 1600
+THUMB_MAX_PX = 400
+
+def _to_jpeg(im, max_px:int, quality:int) -> bytes:
+    im = im.copy()
+    im.thumbnail((max_px, max_px))
+    buf = io.BytesIO()
+    im.convert("RGB").save(buf, format="JPEG", quality=quality, optimize=True, progressive=True)
+    return buf.getvalue()
+
 def files_to_images(uploaded_files):
     out = []
     for up in uploaded_files or []:
         try:
-            out.append({"blob": up.getbuffer().tobytes(), "name": up.name, "mime": up.type or "image/jpeg"})
+            im = ImageOps.exif_transpose(Image.open(io.BytesIO(up.getbuffer())))
+            out.append({"blob": _to_jpeg(im, PHOTO_MAX_PX, 80), "thumb": _to_jpeg(im, THUMB_MAX_PX, 75),
+                        "name": os.path.splitext(up.name)[0] + ".jpg", "mime": "image/jpeg"})
         except Exception:
-            pass
+            try:
+                out.append({"blob": up.getbuffer().tobytes(), "name": up.name, "mime": up.type or "image/jpeg"})
+            except Exception:
+                pass
     return out
 
 def join_list(lst): return "; ".join([x for x in lst if x])
 
+def show_photo(photo_id:int):
+    try: st.image(Image.open(io.BytesIO(fetch_photo_thumb(photo_id))), width=360)
+    except: st.caption("Foto indisponível")
+
+PEP_PAGE_SIZE = 200
+
 CAUSADOR_OPTS = ["Solda","Pintura","Engenharia","Fornecedor","Cliente","Caldeiraria","Usinagem","Planejamento","Qualidade","R.H","Outros"]
 PROCESSO_OPTS = ["Comercial","Compras","Planejamento","Recebimento","Produção","Inspeção Final","Segurança","Meio Ambiente","5S","R.H","Outros"]
 ORIGEM_OPTS = ["Pintura","Orçamento","Usinagem","Almoxarifado","Solda","Montagem","Cliente","Expedição","Preparação","R.H","Outros"]
@@ -470,7 +689,7 @@ if menu == "Nova RNC":
         col0, col1, col2 = st.columns(3)
         emitente = col0.text_input("Emitente", placeholder="Seu nome")
         data_insp = col1.date_input("Data", value=date.today(), format="DD/MM/YYYY")
-        col2.text_input("RNC Nº (gerado automaticamente)", value=next_rnc_num_for_date(data_insp), disabled=True)
+        col2.text_input("RNC Nº (gerado automaticamente)", value=next_rnc_preview(data_insp), disabled=True)
 
         col4, col5, col6 = st.columns(3)
         area = col4.text_input("Área/Local", placeholder="Ex.: Correia TR-2011KS-07")
@@ -499,11 +718,10 @@ if menu == "Nova RNC":
 
         submitted = st.form_submit_button("Salvar RNC")
         if submitted:
-            rnc_num = next_rnc_num_for_date(data_insp)
             imgs = files_to_images(fotos)
             rec = {
                 "data": datetime.combine(data_insp, datetime.min.time()),
-                "rnc_num": rnc_num, "emitente": emitente.strip(), "area": area.strip(), "pep": pep_final or None,
+                "emitente": emitente.strip(), "area": area.strip(), "pep": pep_final or None,
                 "titulo": titulo.strip(), "responsavel": responsavel.strip(),
                 "descricao": descricao.strip(), "referencias": referencias.strip(),
                 "causador": join_list(causador), "processo_envolvido": join_list(processo),
@@ -511,13 +729,12 @@ if menu == "Nova RNC":
                 "severidade": severidade, "categoria": categoria, "acoes": "", "status": "Aberta",
                 "responsavel_acao": responsavel_acao.strip(),
             }
-            iid = insert_inspecao(rec, imgs)
+            iid, rnc_num = insert_inspecao(rec, imgs)
             st.success(f"RNC salva! Nº {rnc_num} • Código interno: #{iid}")
 
 # ====== Consultar / Encerrar / Reabrir ======
 elif menu == "Consultar/Encerrar/Reabrir":
     st.header("Consulta de RNCs")
-    df = fetch_df()
 
     colf1, colf2, colf3, colf4, colf5 = st.columns(5)
     f_status = colf1.multiselect("Status", ["Aberta","Em análise","Em ação","Bloqueada","Encerrada","Cancelada"])
@@ -526,121 +743,116 @@ elif menu == "Consultar/Encerrar/Reabrir":
     f_resp = colf4.text_input("Filtrar por Responsável")
     f_pep  = colf5.text_input("Filtrar por PEP")
 
+    df = fetch_df(status=tuple(f_status) or None, severidade=tuple(f_sev) or None,
+                  area=f_area.strip() or None, responsavel=f_resp.strip() or None, pep=f_pep.strip() or None)
     if not df.empty:
-        if f_status: df = df[df["status"].isin(f_status)]
-        if f_sev: df = df[df["severidade"].isin(f_sev)]
-        if f_area: df = df[df["area"].str.contains(f_area, case=False, na=False)]
-        if f_resp: df = df[df["responsavel"].str.contains(f_resp, case=False, na=False)]
-        if f_pep: df = df[df["pep"].fillna("").str.contains(f_pep, case=False, na=False)]
-
         st.dataframe(df[["id","data","rnc_num","emitente","pep","area","titulo","responsavel",
                          "severidade","categoria","status","encerrada_em","reaberta_em","cancelada_em"]],
                      use_container_width=True, hide_index=True)
 
         st.markdown("---")
-        if not df.empty:
-            sel_id = st.number_input("Ver RNC (ID)", min_value=int(df["id"].min()), max_value=int(df["id"].max()), value=int(df["id"].iloc[0]), step=1)
-            if sel_id in df["id"].values:
-                row = df[df["id"] == sel_id].iloc[0].to_dict()
-                st.subheader(f"RNC Nº {row.get('rnc_num') or '-'} — {row['titulo']} [{row['status']}]")
-
-                if st.button("📄 Gerar PDF desta RNC", key=f"pdf_{sel_id}"):
-                    path = generate_pdf(int(row["id"]))
-                    with open(path, "rb") as _f:
-                        st.download_button("Baixar PDF", _f, file_name=f"RNC_{row.get('rnc_num') or row['id']}.pdf", mime="application/pdf", key=f"dl_{sel_id}")
-
-                c1, c2, c3, c4, c5, c6 = st.columns(6)
-                c1.metric("Data", str(row["data"]))
-                c2.metric("Severidade", row["severidade"])
-                c3.metric("Status", row["status"])
-                c4.metric("PEP", row.get("pep") or "-")
-                c5.metric("RNC Nº", row.get("rnc_num") or "-")
-                c6.metric("Emitente", row.get("emitente") or "-")
-                st.write(f"**Área/Local:** {row['area']}  \n**Resp. inspeção:** {row['responsavel']}  \n**Resp. ação corretiva:** {row.get('responsavel_acao') or '-'}  \n**Categoria:** {row['categoria']}")
-                st.markdown("**Descrição**")
-                st.write(row["descricao"] or "-")
-                st.markdown("**Referências**")
-                st.write(row.get("referencias") or "-")
-                st.markdown("**Causador / Processo envolvido / Origem**")
-                st.write(f"- **Causador:** {row.get('causador') or '-'}")
-                st.write(f"- **Processo:** {row.get('processo_envolvido') or '-'}")
-                st.write(f"- **Origem:** {row.get('origem') or '-'}")
-                st.markdown("**Ação de correção**")
-                st.write(row.get("acao_correcao") or "-")
-
-                tabs = st.tabs(["📸 Abertura", "✅ Encerramento", "♻️ Reabertura", "🗂️ Cancelamento / Exclusão"])
-                with tabs[0]:
-                    for rec in fetch_photos(int(row["id"]), "abertura"):
-                        try: st.image(Image.open(io.BytesIO(rec["blob"])), width=360)
-                        except: st.caption("Foto indisponível")
-                with tabs[1]:
-                    enc = fetch_photos(int(row["id"]), "encerramento")
-                    st.markdown("**Observações de encerramento:**")
-                    st.write(row.get("encerramento_obs") or "-")
-                    st.markdown("**Descrição do fechamento:**")
-                    st.write(row.get("encerramento_desc") or "-")
-                    st.markdown("**Eficácia:** " + (row.get("eficacia") or "-"))
-                    if enc:
-                        st.markdown("**Evidências:**")
-                        for rec in enc:
-                            try: st.image(Image.open(io.BytesIO(rec["blob"])), width=360)
-                            except: st.caption("Foto indisponível")
-                    if st.session_state.is_quality and row["status"] != "Encerrada":
-                        st.markdown("---")
-                        with st.form(f"encerrar_{sel_id}"):
-                            encerr_por = st.text_input("Encerrada por")
-                            encerr_obs = st.text_area("Observações de encerramento")
-                            encerr_desc = st.text_area("Descrição detalhada do fechamento")
-                            eficacia = st.selectbox("Verificação de eficácia", ["A verificar","Eficaz","Não eficaz"])
-                            fotos_enc = st.file_uploader("Evidências (fotos)", type=["jpg","jpeg","png"], accept_multiple_files=True, key=f"enc_{sel_id}")
-                            sub = st.form_submit_button("Encerrar RNC")
-                            if sub:
-                                imgs = files_to_images(fotos_enc)
-                                encerrar_inspecao(int(row["id"]), encerr_por.strip(), encerr_obs.strip(), eficacia, encerr_desc.strip(), imgs)
-                                st.success("RNC encerrada. Recarregue para ver o novo status.")
-                with tabs[2]:
-                    rea = fetch_photos(int(row["id"]), "reabertura")
-                    st.markdown("**Motivo da reabertura:**")
-                    st.write(row.get("reabertura_motivo") or "-")
-                    st.markdown("**Descrição da reabertura:**")
-                    st.write(row.get("reabertura_desc") or "-")
-                    if rea:
-                        st.markdown("**Evidências:**")
-                        for rec in rea:
-                            try: st.image(Image.open(io.BytesIO(rec["blob"])), width=360)
-                            except: st.caption("Foto indisponível")
-                    if st.session_state.is_quality and row["status"] in ["Encerrada","Em ação","Em análise","Bloqueada","Aberta"]:
-                        st.markdown("---")
-                        with st.form(f"reabrir_{sel_id}"):
-                            reab_por = st.text_input("Reaberta por")
-                            reab_motivo = st.text_area("Motivo da reabertura")
-                            reab_desc = st.text_area("Descrição detalhada da reabertura")
-                            fotos_reab = st.file_uploader("Fotos (opcional)", type=["jpg","jpeg","png"], accept_multiple_files=True, key=f"reab_{sel_id}")
-                            sub2 = st.form_submit_button("Reabrir RNC")
-                            if sub2:
-                                imgs = files_to_images(fotos_reab)
-                                reabrir_inspecao(int(row["id"]), reab_por.strip(), reab_motivo.strip(), reab_desc.strip(), imgs)
-                                st.success("RNC reaberta. Status voltou para 'Em ação'.")
-                with tabs[3]:
-                    if st.session_state.is_quality:
-                        st.warning("Atenção: cancelar mantém o registro com status 'Cancelada'. Apagar remove definitivamente os dados e fotos.")
-                        with st.form(f"cancel_{sel_id}"):
-                            c_por = st.text_input("Cancelada por")
-                            c_motivo = st.text_area("Motivo do cancelamento")
-                            do_cancel = st.form_submit_button("Cancelar RNC")
-                            if do_cancel:
-                                cancel_inspecao(int(row["id"]), c_por.strip(), c_motivo.strip())
-                                st.success("RNC marcada como Cancelada.")
-                        st.divider()
-                        with st.form(f"delete_{sel_id}"):
-                            st.error("Exclusão definitiva (não pode ser desfeita).")
-                            confirm = st.text_input("Digite CONFIRMAR para apagar definitivamente:")
-                            do_delete = st.form_submit_button("Apagar RNC (definitivo)")
-                            if do_delete and confirm.strip().upper() == "CONFIRMAR":
-                                delete_inspecao(int(row["id"]))
-                                st.success("RNC apagada permanentemente (registros e fotos). Atualize a página.")
-                            elif do_delete:
-                                st.warning("Digite CONFIRMAR exatamente para prosseguir.")
+        sel_id = st.number_input("Ver RNC (ID)", min_value=int(df["id"].min()), max_value=int(df["id"].max()), value=int(df["id"].iloc[0]), step=1)
+        if sel_id in df["id"].values:
+            row = df[df["id"] == sel_id].iloc[0].to_dict()
+            st.subheader(f"RNC Nº {row.get('rnc_num') or '-'} — {row['titulo']} [{row['status']}]")
+            photos = fetch_photos_all(int(row["id"]))
+
+            if st.button("📄 Gerar PDF desta RNC", key=f"pdf_{sel_id}"):
+                pdf_version = (row["status"], str(row["encerrada_em"]), str(row["reaberta_em"]), str(row["cancelada_em"]), sum(map(len, photos.values())))
+                pdf_bytes = generate_pdf(int(row["id"]), pdf_version)
+                st.download_button("Baixar PDF", pdf_bytes, file_name=f"RNC_{row.get('rnc_num') or row['id']}.pdf", mime="application/pdf", key=f"dl_{sel_id}")
+
+            c1, c2, c3, c4, c5, c6 = st.columns(6)
+            c1.metric("Data", str(row["data"]))
+            c2.metric("Severidade", row["severidade"])
+            c3.metric("Status", row["status"])
+            c4.metric("PEP", row.get("pep") or "-")
+            c5.metric("RNC Nº", row.get("rnc_num") or "-")
+            c6.metric("Emitente", row.get("emitente") or "-")
+            st.write(f"**Área/Local:** {row['area']}  \n**Resp. inspeção:** {row['responsavel']}  \n**Resp. ação corretiva:** {row.get('responsavel_acao') or '-'}  \n**Categoria:** {row['categoria']}")
+            st.markdown("**Descrição**")
+            st.write(row["descricao"] or "-")
+            st.markdown("**Referências**")
+            st.write(row.get("referencias") or "-")
+            st.markdown("**Causador / Processo envolvido / Origem**")
+            st.write(f"- **Causador:** {row.get('causador') or '-'}")
+            st.write(f"- **Processo:** {row.get('processo_envolvido') or '-'}")
+            st.write(f"- **Origem:** {row.get('origem') or '-'}")
+            st.markdown("**Ação de correção**")
+            st.write(row.get("acao_correcao") or "-")
+
+            tabs = st.tabs(["📸 Abertura", "✅ Encerramento", "♻️ Reabertura", "🗂️ Cancelamento / Exclusão"])
+            with tabs[0]:
+                for rec in photos["abertura"]:
+                    show_photo(rec["id"])
+            with tabs[1]:
+                enc = photos["encerramento"]
+                st.markdown("**Observações de encerramento:**")
+                st.write(row.get("encerramento_obs") or "-")
+                st.markdown("**Descrição do fechamento:**")
+                st.write(row.get("encerramento_desc") or "-")
+                st.markdown("**Eficácia:** " + (row.get("eficacia") or "-"))
+                if enc:
+                    st.markdown("**Evidências:**")
+                    for rec in enc:
+                        show_photo(rec["id"])
+                if st.session_state.is_quality and row["status"] != "Encerrada":
+                    st.markdown("---")
+                    with st.form(f"encerrar_{sel_id}"):
+                        encerr_por = st.text_input("Encerrada por")
+                        encerr_obs = st.text_area("Observações de encerramento")
+                        encerr_desc = st.text_area("Descrição detalhada do fechamento")
+                        eficacia = st.selectbox("Verificação de eficácia", ["A verificar","Eficaz","Não eficaz"])
+                        fotos_enc = st.file_uploader("Evidências (fotos)", type=["jpg","jpeg","png"], accept_multiple_files=True, key=f"enc_{sel_id}")
+                        sub = st.form_submit_button("Encerrar RNC")
+                        if sub:
+                            imgs = files_to_images(fotos_enc)
+                            encerrar_inspecao(int(row["id"]), encerr_por.strip(), encerr_obs.strip(), eficacia, encerr_desc.strip(), imgs)
+                            st.success("RNC encerrada. Recarregue para ver o novo status.")
+            with tabs[2]:
+                rea = photos["reabertura"]
+                st.markdown("**Motivo da reabertura:**")
+                st.write(row.get("reabertura_motivo") or "-")
+                st.markdown("**Descrição da reabertura:**")
+                st.write(row.get("reabertura_desc") or "-")
+                if rea:
+                    st.markdown("**Evidências:**")
+                    for rec in rea:
+                        show_photo(rec["id"])
+                if st.session_state.is_quality and row["status"] in ["Encerrada","Em ação","Em análise","Bloqueada","Aberta"]:
+                    st.markdown("---")
+                    with st.form(f"reabrir_{sel_id}"):
+                        reab_por = st.text_input("Reaberta por")
+                        reab_motivo = st.text_area("Motivo da reabertura")
+                        reab_desc = st.text_area("Descrição detalhada da reabertura")
+                        fotos_reab = st.file_uploader("Fotos (opcional)", type=["jpg","jpeg","png"], accept_multiple_files=True, key=f"reab_{sel_id}")
+                        sub2 = st.form_submit_button("Reabrir RNC")
+                        if sub2:
+                            imgs = files_to_images(fotos_reab)
+                            reabrir_inspecao(int(row["id"]), reab_por.strip(), reab_motivo.strip(), reab_desc.strip(), imgs)
+                            st.success("RNC reaberta. Status voltou para 'Em ação'.")
+            with tabs[3]:
+                if st.session_state.is_quality:
+                    st.warning("Atenção: cancelar mantém o registro com status 'Cancelada'. Apagar remove definitivamente os dados e fotos.")
+                    with st.form(f"cancel_{sel_id}"):
+                        c_por = st.text_input("Cancelada por")
+                        c_motivo = st.text_area("Motivo do cancelamento")
+                        do_cancel = st.form_submit_button("Cancelar RNC")
+                        if do_cancel:
+                            cancel_inspecao(int(row["id"]), c_por.strip(), c_motivo.strip())
+                            st.success("RNC marcada como Cancelada.")
+                    st.divider()
+                    with st.form(f"delete_{sel_id}"):
+                        st.error("Exclusão definitiva (não pode ser desfeita).")
+                        confirm = st.text_input("Digite CONFIRMAR para apagar definitivamente:")
+                        do_delete = st.form_submit_button("Apagar RNC (definitivo)")
+                        if do_delete and confirm.strip().upper() == "CONFIRMAR":
+                            delete_inspecao(int(row["id"]))
+                            st.success("RNC apagada permanentemente (registros e fotos). Atualize a página.")
+                        elif do_delete:
+                            st.warning("Digite CONFIRMAR exatamente para prosseguir.")
+    else:
+        st.info("Nenhuma RNC encontrada com esses filtros.")
 
 # ====== Importar / Exportar ======
 elif menu == "Importar/Exportar":
@@ -650,21 +862,27 @@ elif menu == "Importar/Exportar":
         st.subheader("Importar CSV para restaurar/atualizar RNCs")
         up = st.file_uploader("Selecione o CSV (ponto e vírgula ou vírgula)", type=["csv"], key="csv_imp")
         if up is not None:
-            try:
-                df_imp = pd.read_csv(up)
-            except Exception:
-                up.seek(0)
-                df_imp = pd.read_csv(up, sep=";")
-            df_norm = normalize_df_cols(df_imp)
-            count = upsert_from_csv(df_norm)
-            st.success(f"{count} registro(s) importado(s)/atualizado(s).")
+            h = upload_digest(up)
+            if not up.size:
+                st.warning("Arquivo vazio.")
+            elif st.session_state.get("last_csv_hash") == h:
+                st.info("Já importado.")
+            else:
+                try:
+                    chunks = pd.read_csv(up, sep=sniff_sep(up), chunksize=CSV_CHUNK_ROWS, dtype=str, engine="c")
+                except pd.errors.EmptyDataError:
+                    st.warning("Arquivo vazio.")
+                else:
+                    count = upsert_from_csv(normalize_df_cols(chunk) for chunk in chunks)
+                    st.session_state["last_csv_hash"] = h
+                    st.success(f"{count} registro(s) importado(s)/atualizado(s).")
 
     st.subheader("Exportar CSV")
-    df = fetch_df()
-    if df.empty:
+    version = export_version()
+    if not version[0]:
         st.info("Sem dados para exportar.")
     else:
-        csv_bytes = df.to_csv(index=False, sep=";").encode("utf-8-sig")
+        csv_bytes = export_csv_bytes(version)
         st.download_button("Baixar CSV", data=csv_bytes, file_name="rnc_export_v2_7_1.csv", mime="text/csv")
 
 # ====== Gerenciar PEPs ======
@@ -684,18 +902,31 @@ elif menu == "Gerenciar PEPs":
         st.subheader("Importar lista (CSV)")
         up = st.file_uploader("Arquivo CSV com uma coluna chamada 'code'", type=["csv"])
         if up is not None:
-            try:
-                df_csv = pd.read_csv(up)
-            except Exception:
-                up.seek(0)
-                df_csv = pd.read_csv(up, sep=";")
-            if "code" in df_csv.columns:
-                n = add_peps_bulk(df_csv["code"].astype(str).tolist())
-                st.success(f"{n} PEP(s) importado(s).")
+            h = upload_digest(up)
+            if not up.size:
+                st.warning("Arquivo vazio.")
+            elif st.session_state.get("last_pep_csv_hash") == h:
+                st.info("Já importado.")
             else:
-                st.error("CSV deve conter uma coluna chamada 'code'.")
+                try:
+                    df_csv = pd.read_csv(up, sep=sniff_sep(up), usecols=lambda c: c == "code", dtype={"code": "string"})
+                except pd.errors.EmptyDataError:
+                    st.warning("Arquivo vazio.")
+                else:
+                    if "code" in df_csv.columns:
+                        n = add_peps_bulk(df_csv["code"].to_numpy(dtype=object, na_value="").tolist())
+                        st.session_state["last_pep_csv_hash"] = h
+                        st.success(f"{n} PEP(s) importado(s).")
+                    else:
+                        st.error("CSV deve conter uma coluna chamada 'code'.")
     st.markdown("---")
     st.subheader("Lista atual de PEPs")
-    with engine.begin() as conn:
-        df_pep = pd.read_sql(text("SELECT code AS 'PEP — descrição' FROM peps ORDER BY code"), conn)
-    st.dataframe(df_pep, use_container_width=True, hide_index=True)
+    cq, ca = st.columns([3,1])
+    q = cq.text_input("Filtrar PEP", placeholder="Código ou parte da descrição")
+    show_all = ca.checkbox("Mostrar todos")
+    sql = "SELECT code FROM peps WHERE code LIKE :q ESCAPE '\\' ORDER BY code" + ("" if show_all else f" LIMIT {PEP_PAGE_SIZE}")
+    with engine.connect() as conn:
+        codes = conn.execute(text(sql), {"q": like_pattern(q.strip())}).scalars().all()
+    st.dataframe({"PEP — descrição": codes}, use_container_width=True, hide_index=True)
+    if not show_all and len(codes) == PEP_PAGE_SIZE:
+        st.caption(f"Mostrando os primeiros {PEP_PAGE_SIZE} PEPs. Refine o filtro ou marque 'Mostrar todos'.")